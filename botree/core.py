@@ -1,7 +1,9 @@
 """Botree core functions."""
+from functools import cached_property
 from typing import Optional
 
 from boto3.session import Session as boto_session
+from botree.ec2 import EC2
 from botree.s3 import S3
 from botree.secrets_manager import SecretsManager
 
@@ -45,3 +47,13 @@ class Session:
     def secrets_manager(self) -> SecretsManager:
         """Get a SecretsManager instance."""
         return SecretsManager(self.session)
+
+    @cached_property
+    def ec2(self) -> EC2:
+        """
+        Get the session EC2 instance.
+
+        The same instance is returned on every access, so concurrent lookups
+        are batched and instance descriptions cached across calls.
+        """
+        return EC2(self.session)
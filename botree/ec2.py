@@ -0,0 +1,1113 @@
+"""Botree EC2 utilities."""
+
+import re
+import threading
+import time
+
+from collections import deque
+from concurrent.futures import Future
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from datetime import timedelta
+from datetime import timezone
+from functools import cached_property
+from functools import lru_cache
+from itertools import chain
+from itertools import islice
+from typing import Any
+from typing import Callable
+from typing import Deque
+from typing import Dict
+from typing import FrozenSet
+from typing import Iterable
+from typing import Iterator
+from typing import List
+from typing import Optional
+from typing import Pattern
+from typing import Set
+from typing import Tuple
+from weakref import WeakKeyDictionary
+
+from boto3.session import Session
+from botocore.client import BaseClient
+from botocore.config import Config
+from botocore.exceptions import ClientError
+
+
+# GetMetricData accepts at most 500 queries per request.
+METRIC_DATA_QUERIES_LIMIT = 500
+
+# GetMetricData requests sent concurrently by get_instance_cpu_usage.
+CPU_USAGE_WORKERS = 20
+
+# GetMetricData periods below a minute (high resolution metrics only).
+HIGH_RESOLUTION_PERIODS = (1, 5, 10, 30)
+
+# Aggregation levels accepted by get_instance_cpu_usage.
+CPU_USAGE_GROUPS = ("instance", "auto_scaling_group")
+
+# DescribeInstances returns at most 1000 instances per page.
+DESCRIBE_INSTANCES_PAGE_SIZE = 1000
+
+# StartInstances and StopInstances accept at most 1000 ids per request.
+INSTANCE_IDS_LIMIT = 1000
+
+INSTANCE_ID_PATTERN = re.compile(r"^i-[0-9a-f]{8,17}$")
+
+# Values accepted by a single DescribeInstances filter.
+FILTER_VALUES_LIMIT = 200
+
+# Concurrent single-name lookups are coalesced for up to this many seconds...
+DESCRIBE_BATCH_DELAY = 0.3
+# ...or until this many lookups are waiting.
+DESCRIBE_BATCH_SIZE = 50
+
+# Seconds during which instance descriptions are reused.
+DESCRIBE_CACHE_TTL = 5.0
+
+# Back off client side when AWS starts throttling the concurrent requests, and
+# keep enough pooled connections for them not to wait on each other.
+CLIENT_CONFIG = Config(
+    max_pool_connections=50, retries={"mode": "adaptive", "max_attempts": 10}
+)
+
+# Default clients, shared by every EC2 instance built on the same boto3 session
+# and released along with the session.
+_shared_clients: "WeakKeyDictionary[Session, Dict[str, BaseClient]]" = (
+    WeakKeyDictionary()
+)
+_shared_clients_lock = threading.Lock()
+
+
+def _tag_value(instance: dict, key: str) -> Optional[str]:
+    """
+    Return the value of an instance tag.
+
+    A plain loop returning on the first match: no generator is created per
+    instance and the remaining tags are not scanned.
+
+    Parameters
+    ----------
+    instance : dict
+        Instance description as returned by the EC2 API.
+    key : str
+        Tag key.
+
+    Returns
+    -------
+    Optional[str]
+        Tag value, None when the instance has no such tag.
+    """
+    for tag in instance.get("Tags") or ():
+        if tag["Key"] == key:
+            return tag["Value"]
+
+    return None
+
+
+def _peek(items: Iterable[dict]) -> Optional[Iterator[dict]]:
+    """Return an iterator over items, or None if there are none."""
+    iterator = iter(items)
+    first = next(iterator, None)
+    if first is None:
+        return None
+
+    return chain([first], iterator)
+
+
+@lru_cache(maxsize=256)
+def _name_pattern(name: str) -> Pattern[str]:
+    """Compile a "tag:Name" filter value, with * and ? as wildcards like EC2."""
+    return re.compile(
+        "".join(
+            ".*" if char == "*" else "." if char == "?" else re.escape(char)
+            for char in name
+        ),
+        re.DOTALL,
+    )
+
+
+def _matches_name(instance: dict, name: str) -> bool:
+    """Whether an instance would match a "tag:Name" filter value."""
+    tag = _tag_value(instance, "Name")
+    return tag is not None and _name_pattern(name).fullmatch(tag) is not None
+
+
+def _instance_name(instance: dict) -> str:
+    """Return the "Name" tag of an instance description."""
+    return _tag_value(instance, "Name") or "N/A"
+
+
+class InstanceNotFoundError(ValueError):
+    """No instance matches the requested name or id."""
+
+    def __init__(self, instance_name: str):
+        super().__init__(f"No instance '{instance_name}' was found.")
+        self.instance_name = instance_name
+
+
+class _DescribeInstancesBatcher:
+    """
+    Coalesce concurrent instance name lookups into one DescribeInstances call.
+
+    A lookup is sent right away when no other one is queued or in flight.
+    Otherwise it waits for up to max_delay seconds (or until max_size lookups
+    are queued) and is sent along with every lookup queued meanwhile.
+    """
+
+    def __init__(
+        self,
+        describe: Callable[[List[str]], List[dict]],
+        max_delay: float = DESCRIBE_BATCH_DELAY,
+        max_size: int = DESCRIBE_BATCH_SIZE,
+    ):
+        self.describe = describe
+        self.max_delay = max_delay
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._pending: List[Tuple[Tuple[str, ...], Future]] = []
+        self._timer: Optional[threading.Timer] = None
+        self._in_flight = 0
+
+    def lookup(self, instance_names: List[str]) -> List[dict]:
+        """
+        Queue a lookup and wait for the batch holding it to be flushed.
+
+        Parameters
+        ----------
+        instance_names : List[str]
+            Values of the instance "Name" tag.
+
+        Returns
+        -------
+        List[dict]
+            Instance descriptions matching instance_names.
+        """
+        future: Future = Future()
+        batch = None
+
+        with self._lock:
+            self._pending.append((tuple(instance_names), future))
+            lone = len(self._pending) == 1 and not self._in_flight
+            if lone or len(self._pending) >= self.max_size:
+                batch = self._take_pending()
+            elif self._timer is None:
+                self._timer = threading.Timer(self.max_delay, self._flush)
+                self._timer.daemon = True
+                self._timer.start()
+
+        if batch:
+            self._send(batch)
+
+        return future.result()
+
+    def _take_pending(self) -> List[Tuple[Tuple[str, ...], Future]]:
+        """Detach the pending lookups. Must be called holding the lock."""
+        batch, self._pending = self._pending, []
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if batch:
+            self._in_flight += 1
+        return batch
+
+    def _flush(self):
+        """Send whatever is pending once the batch delay expires."""
+        with self._lock:
+            batch = self._take_pending()
+
+        if batch:
+            self._send(batch)
+
+    def _send(self, batch: List[Tuple[Tuple[str, ...], Future]]):
+        """Describe all names of a batch at once and dispatch the results."""
+        names = sorted({name for key, _ in batch for name in key})
+
+        try:
+            instances = self.describe(names)
+        except Exception as error:
+            for _, future in batch:
+                future.set_exception(error)
+            return
+        finally:
+            with self._lock:
+                self._in_flight -= 1
+
+        # names may hold wildcards, so match them the way the EC2 filter does
+        for key, future in batch:
+            future.set_result(
+                [
+                    instance
+                    for instance in instances
+                    if any(_matches_name(instance, name) for name in key)
+                ]
+            )
+
+
+class EC2:
+    """AWS EC2 wrapper."""
+
+    def __init__(
+        self,
+        session: Session,
+        client_kwargs: dict = dict(),
+        batch_delay: Optional[float] = DESCRIBE_BATCH_DELAY,
+        cache_ttl: Optional[float] = DESCRIBE_CACHE_TTL,
+    ):
+        """
+        EC2 class init.
+
+        Parameters
+        ----------
+        session : Session
+            Boto3 session.
+        client_kwargs : dict, optional
+            Extra arguments to the boto3 clients, by default dict(). A "config"
+            is merged over the default configuration (adaptive retries, 50
+            pooled connections). Without extra arguments, clients are created
+            on first use and shared with every EC2 instance of the session.
+        batch_delay : Optional[float], optional
+            Seconds during which single-name lookups issued while another one
+            is in flight are coalesced into one DescribeInstances call,
+            by default 0.3. A lone lookup is sent right away. None or 0
+            disables the batching.
+        cache_ttl : Optional[float], optional
+            Seconds during which instance descriptions are reused by later
+            calls, by default 5. None or 0 disables the cache. Starting or
+            stopping instances clears it.
+        """
+        self.session = session
+        self.client_kwargs = client_kwargs
+        self._batcher = (
+            _DescribeInstancesBatcher(self._query_instances, max_delay=batch_delay)
+            if batch_delay
+            else None
+        )
+        self.cache_ttl = cache_ttl
+        self._cache: Dict[Tuple[Optional[FrozenSet[str]], int], List[dict]] = dict()
+        self._cache_lock = threading.Lock()
+        # bumped on every clear, so listings started before it aren't cached
+        self._cache_generation = 0
+
+    @cached_property
+    def ec2_client(self) -> BaseClient:
+        """EC2 client."""
+        return self._client("ec2")
+
+    @cached_property
+    def cw_client(self) -> BaseClient:
+        """CloudWatch client."""
+        return self._client("cloudwatch")
+
+    def _client(self, service_name: str) -> BaseClient:
+        """Get the session shared client, or a dedicated one if customized."""
+        if self.client_kwargs:
+            client_kwargs = dict(self.client_kwargs)
+            client_kwargs["config"] = (
+                CLIENT_CONFIG.merge(client_kwargs["config"])
+                if client_kwargs.get("config")
+                else CLIENT_CONFIG
+            )
+            return self.session.client(service_name=service_name, **client_kwargs)
+
+        with _shared_clients_lock:
+            clients = _shared_clients.setdefault(self.session, dict())
+            if service_name not in clients:
+                clients[service_name] = self.session.client(
+                    service_name=service_name, config=CLIENT_CONFIG
+                )
+            return clients[service_name]
+
+    def _describe_instances(
+        self,
+        instance_names: Optional[List[str]] = None,
+        instance_ids: Optional[List[str]] = None,
+    ) -> Iterable[dict]:
+        """
+        List instances, optionally filtered by the "Name" tag or by id.
+
+        Name lookups are cached for cache_ttl seconds, and single-name lookups
+        are coalesced with concurrent ones when batching is enabled.
+
+        Parameters
+        ----------
+        instance_names : Optional[List[str]], optional
+            Values of the instance "Name" tag, by default None (all instances).
+        instance_ids : Optional[List[str]], optional
+            Instance ids, by default None. When given, instance_names is
+            ignored and the instances are described directly.
+
+        Returns
+        -------
+        Iterable[dict]
+            Instance descriptions as returned by the EC2 API, lazily fetched
+            page by page unless the lookup was cached or batched.
+        """
+        if instance_ids:
+            return self._iter_instances(instance_ids=instance_ids)
+
+        if not self.cache_ttl:
+            return self._fetch_instances(instance_names)
+
+        key = (
+            frozenset(instance_names) if instance_names else None,
+            int(time.monotonic() / self.cache_ttl),
+        )
+        with self._cache_lock:
+            cached = self._cache.get(key)
+            generation = self._cache_generation
+
+        if cached is not None:
+            return cached
+
+        return self._cache_instances(
+            key, generation, self._fetch_instances(instance_names)
+        )
+
+    def _cache_instances(
+        self,
+        key: Tuple[Optional[FrozenSet[str]], int],
+        generation: int,
+        instances: Iterable[dict],
+    ) -> Iterator[dict]:
+        """
+        Yield instances, caching them once the listing is fully consumed.
+
+        Nothing is cached if the cache was cleared since the listing started,
+        as instances may have been started or stopped meanwhile.
+        """
+        collected = []
+        for instance in instances:
+            collected.append(instance)
+            yield instance
+
+        with self._cache_lock:
+            if generation != self._cache_generation:
+                return
+
+            # entries from past time buckets are expired, drop them
+            self._cache = {k: v for k, v in self._cache.items() if k[1] == key[1]}
+            self._cache[key] = collected
+
+    def _clear_cache(self):
+        """Forget every cached instance description."""
+        with self._cache_lock:
+            self._cache.clear()
+            self._cache_generation += 1
+
+    def _fetch_instances(
+        self, instance_names: Optional[List[str]] = None
+    ) -> Iterable[dict]:
+        """List instances, batching single-name lookups when enabled."""
+        if self._batcher and instance_names and len(instance_names) == 1:
+            return self._batcher.lookup(instance_names)
+
+        return self._iter_instances(instance_names)
+
+    def _iter_instances(
+        self,
+        instance_names: Optional[List[str]] = None,
+        instance_ids: Optional[List[str]] = None,
+    ) -> Iterator[dict]:
+        """Paginate DescribeInstances, optionally filtered by "Name" tag or id."""
+        requests: List[Dict[str, Any]] = []
+        if instance_ids:
+            # MaxResults (the page size) can't be combined with InstanceIds
+            requests = [
+                dict(InstanceIds=instance_ids[offset : offset + INSTANCE_IDS_LIMIT])
+                for offset in range(0, len(instance_ids), INSTANCE_IDS_LIMIT)
+            ]
+        else:
+            filters = []
+            if instance_names:
+                filters.append({"Name": "tag:Name", "Values": instance_names})
+            requests.append(
+                dict(
+                    Filters=filters,
+                    PaginationConfig={"PageSize": DESCRIBE_INSTANCES_PAGE_SIZE},
+                )
+            )
+
+        paginator = self.ec2_client.get_paginator("describe_instances")
+        for request in requests:
+            for page in paginator.paginate(**request):
+                for reservation in page["Reservations"]:
+                    yield from reservation["Instances"]
+
+    def _query_instances(self, instance_names: List[str]) -> List[dict]:
+        """Fetch every instance tagged with one of the given names."""
+        return list(self._iter_instances(instance_names))
+
+    def _change_instances_state(
+        self,
+        instance_names: Optional[List[str]],
+        instance_ids: Optional[List[str]],
+        action: Callable,
+        response_key: str,
+    ) -> List[Dict[str, Optional[str]]]:
+        """
+        Apply a state change to every given instance.
+
+        Names are resolved with a single DescribeInstances call, ids skip the
+        lookup, and instances are changed with as few multi-id calls as the
+        API limit allows.
+
+        Parameters
+        ----------
+        instance_names : Optional[List[str]]
+            Values of the instance "Name" tag. Values shaped like an instance
+            id (i-...) are handled as ids.
+        instance_ids : Optional[List[str]]
+            Instance ids.
+        action : Callable
+            EC2 client method, either start_instances or stop_instances.
+        response_key : str
+            Key holding the state changes in the action response.
+
+        Returns
+        -------
+        List[Dict[str, Optional[str]]]
+            Instance id, name, previous and current state of each instance.
+            Names without a matching instance and unknown ids are reported
+            with a "not-found" current state.
+        """
+        instance_ids = list(instance_ids or [])
+        lookup_names = []
+        for name in instance_names or []:
+            if INSTANCE_ID_PATTERN.match(name):
+                instance_ids.append(name)
+            else:
+                lookup_names.append(name)
+
+        names = {instance_id: "N/A" for instance_id in instance_ids}
+        missing_names: List[str] = []
+        if lookup_names:
+            instances = list(self._describe_instances(lookup_names))
+            names.update(
+                {
+                    instance["InstanceId"]: _instance_name(instance)
+                    for instance in instances
+                }
+            )
+            # names may hold wildcards: a name is missing when it matched nothing
+            missing_names = [
+                name
+                for name in lookup_names
+                if not any(_matches_name(instance, name) for instance in instances)
+            ]
+        instance_ids = list(names)
+
+        changes, unknown_ids = self._apply_state_change(
+            action, response_key, instance_ids
+        )
+
+        transitions: List[Dict[str, Optional[str]]] = [
+            {
+                "InstanceId": change["InstanceId"],
+                "Name": names[change["InstanceId"]],
+                "PreviousState": change["PreviousState"]["Name"],
+                "CurrentState": change["CurrentState"]["Name"],
+            }
+            for change in changes
+        ]
+
+        for instance_id in unknown_ids:
+            transitions.append(
+                {
+                    "InstanceId": instance_id,
+                    "Name": names[instance_id],
+                    "PreviousState": None,
+                    "CurrentState": "not-found",
+                }
+            )
+
+        for name in missing_names:
+            transitions.append(
+                {
+                    "InstanceId": None,
+                    "Name": name,
+                    "PreviousState": None,
+                    "CurrentState": "not-found",
+                }
+            )
+
+        return transitions
+
+    def _apply_state_change(
+        self, action: Callable, response_key: str, instance_ids: List[str]
+    ) -> Tuple[List[dict], List[str]]:
+        """
+        Call a state change action on instances, leaving out unknown ids.
+
+        Ids given by the caller aren't looked up beforehand, and EC2 rejects a
+        whole request when one of its ids doesn't exist. When that happens,
+        the ids are checked with a DescribeInstances "instance-id" filter, and
+        the request is retried with the existing ones.
+
+        Parameters
+        ----------
+        action : Callable
+            EC2 client method, either start_instances or stop_instances.
+        response_key : str
+            Key holding the state changes in the action response.
+        instance_ids : List[str]
+            Instance ids.
+
+        Returns
+        -------
+        Tuple[List[dict], List[str]]
+            State changes as returned by the EC2 API, and the unknown ids.
+        """
+        changes: List[dict] = []
+        unknown_ids: List[str] = []
+        for offset in range(0, len(instance_ids), INSTANCE_IDS_LIMIT):
+            chunk = instance_ids[offset : offset + INSTANCE_IDS_LIMIT]
+            try:
+                response = action(InstanceIds=chunk)
+            except ClientError as error:
+                if error.response["Error"]["Code"] not in (
+                    "InvalidInstanceID.NotFound",
+                    "InvalidInstanceID.Malformed",
+                ):
+                    raise
+
+                # the error message doesn't reliably list only the unknown ids
+                existing = self._existing_instance_ids(chunk)
+                unknown_ids.extend(i for i in chunk if i not in existing)
+                chunk = [i for i in chunk if i in existing]
+                if not chunk:
+                    continue
+                response = action(InstanceIds=chunk)
+
+            self._clear_cache()
+            changes.extend(response[response_key])
+
+        return changes, unknown_ids
+
+    def _existing_instance_ids(self, instance_ids: List[str]) -> Set[str]:
+        """Return which of the given ids exist, without failing on unknown ones."""
+        paginator = self.ec2_client.get_paginator("describe_instances")
+
+        existing: Set[str] = set()
+        for offset in range(0, len(instance_ids), FILTER_VALUES_LIMIT):
+            filters = [
+                {
+                    "Name": "instance-id",
+                    "Values": instance_ids[offset : offset + FILTER_VALUES_LIMIT],
+                }
+            ]
+            for page in paginator.paginate(Filters=filters):
+                for reservation in page["Reservations"]:
+                    existing.update(
+                        instance["InstanceId"] for instance in reservation["Instances"]
+                    )
+
+        return existing
+
+    def stop_instances(
+        self,
+        instance_names: Optional[List[str]] = None,
+        instance_ids: Optional[List[str]] = None,
+    ) -> List[Dict[str, Optional[str]]]:
+        """
+        Stop every instance tagged with one of the given names or ids.
+
+        Parameters
+        ----------
+        instance_names : Optional[List[str]], optional
+            Values of the instance "Name" tag, by default None. Values shaped
+            like an instance id (i-...) are handled as ids.
+        instance_ids : Optional[List[str]], optional
+            Instance ids, by default None. No DescribeInstances call is made
+            for them; unknown ids are reported as "not-found".
+
+        Returns
+        -------
+        List[Dict[str, Optional[str]]]
+            Instance id, name, previous and current state of each instance.
+        """
+        return self._change_instances_state(
+            instance_names,
+            instance_ids,
+            self.ec2_client.stop_instances,
+            "StoppingInstances",
+        )
+
+    def start_instances(
+        self,
+        instance_names: Optional[List[str]] = None,
+        instance_ids: Optional[List[str]] = None,
+    ) -> List[Dict[str, Optional[str]]]:
+        """
+        Start every instance tagged with one of the given names or ids.
+
+        Parameters
+        ----------
+        instance_names : Optional[List[str]], optional
+            Values of the instance "Name" tag, by default None. Values shaped
+            like an instance id (i-...) are handled as ids.
+        instance_ids : Optional[List[str]], optional
+            Instance ids, by default None. No DescribeInstances call is made
+            for them; unknown ids are reported as "not-found".
+
+        Returns
+        -------
+        List[Dict[str, Optional[str]]]
+            Instance id, name, previous and current state of each instance.
+        """
+        return self._change_instances_state(
+            instance_names,
+            instance_ids,
+            self.ec2_client.start_instances,
+            "StartingInstances",
+        )
+
+    def stop_instance(
+        self, instance_name: Optional[str] = None, instance_id: Optional[str] = None
+    ) -> List[Dict[str, Optional[str]]]:
+        """
+        Stop the instances tagged with the given name, or the given instance.
+
+        Parameters
+        ----------
+        instance_name : Optional[str], optional
+            Value of the instance "Name" tag, or an instance id (i-...),
+            by default None.
+        instance_id : Optional[str], optional
+            Instance id, by default None. Takes precedence over instance_name
+            and skips the DescribeInstances call.
+
+        Returns
+        -------
+        List[Dict[str, Optional[str]]]
+            Instance id, name, previous and current state of each instance.
+
+        Raises
+        ------
+        ValueError
+            If neither instance_name nor instance_id is given.
+        InstanceNotFoundError
+            If no instance matches instance_name or instance_id.
+        """
+        if instance_id:
+            transitions = self.stop_instances(instance_ids=[instance_id])
+        elif instance_name:
+            transitions = self.stop_instances([instance_name])
+        else:
+            raise ValueError("Either instance_name or instance_id must be given.")
+
+        if transitions[0]["CurrentState"] == "not-found":
+            raise InstanceNotFoundError(str(instance_id or instance_name))
+
+        return transitions
+
+    def start_instance(
+        self, instance_name: Optional[str] = None, instance_id: Optional[str] = None
+    ) -> List[Dict[str, Optional[str]]]:
+        """
+        Start the instances tagged with the given name, or the given instance.
+
+        Parameters
+        ----------
+        instance_name : Optional[str], optional
+            Value of the instance "Name" tag, or an instance id (i-...),
+            by default None.
+        instance_id : Optional[str], optional
+            Instance id, by default None. Takes precedence over instance_name
+            and skips the DescribeInstances call.
+
+        Returns
+        -------
+        List[Dict[str, Optional[str]]]
+            Instance id, name, previous and current state of each instance.
+
+        Raises
+        ------
+        ValueError
+            If neither instance_name nor instance_id is given.
+        InstanceNotFoundError
+            If no instance matches instance_name or instance_id.
+        """
+        if instance_id:
+            transitions = self.start_instances(instance_ids=[instance_id])
+        elif instance_name:
+            transitions = self.start_instances([instance_name])
+        else:
+            raise ValueError("Either instance_name or instance_id must be given.")
+
+        if transitions[0]["CurrentState"] == "not-found":
+            raise InstanceNotFoundError(str(instance_id or instance_name))
+
+        return transitions
+
+    def get_instance_id(self, instance_name: Optional[str] = None) -> List[str]:
+        """
+        Get the ids of the instances tagged with the given name.
+
+        Parameters
+        ----------
+        instance_name : Optional[str], optional
+            Value of the instance "Name" tag, by default None (all instances).
+
+        Returns
+        -------
+        List[str]
+            Instance ids.
+
+        Raises
+        ------
+        InstanceNotFoundError
+            If instance_name is given and no instance matches it.
+        """
+        instance_ids = [
+            instance["InstanceId"]
+            for instance in self._describe_instances(
+                [instance_name] if instance_name else None
+            )
+        ]
+
+        if instance_name and not instance_ids:
+            raise InstanceNotFoundError(instance_name)
+
+        return instance_ids
+
+    def _iter_instance_states(
+        self, instance_ids: Optional[List[str]] = None
+    ) -> Iterator[dict]:
+        """Paginate DescribeInstanceStatus, a much smaller payload than instances."""
+        requests: List[Dict[str, Any]] = []
+        if instance_ids:
+            # MaxResults (the page size) can't be combined with InstanceIds
+            requests = [
+                dict(
+                    InstanceIds=instance_ids[offset : offset + INSTANCE_IDS_LIMIT],
+                    IncludeAllInstances=True,
+                )
+                for offset in range(0, len(instance_ids), INSTANCE_IDS_LIMIT)
+            ]
+        else:
+            requests.append(
+                dict(
+                    IncludeAllInstances=True,
+                    PaginationConfig={"PageSize": DESCRIBE_INSTANCES_PAGE_SIZE},
+                )
+            )
+
+        paginator = self.ec2_client.get_paginator("describe_instance_status")
+        for request in requests:
+            for page in paginator.paginate(**request):
+                yield from page["InstanceStatuses"]
+
+    def get_instance_status(
+        self,
+        instance_name: Optional[str] = None,
+        instance_ids: Optional[List[str]] = None,
+        with_names: bool = True,
+    ) -> Iterator[Dict[str, str]]:
+        """
+        Get the state of instances.
+
+        States are yielded as the DescribeInstances pages arrive. Wrap the
+        call with list() to get them all at once.
+
+        Parameters
+        ----------
+        instance_name : Optional[str], optional
+            Value of the instance "Name" tag, by default None (all instances).
+        instance_ids : Optional[List[str]], optional
+            Instance ids, by default None. Takes precedence over instance_name.
+        with_names : bool, optional
+            Include the instances name, by default True. If False, states are
+            read from DescribeInstanceStatus, which returns only ids and
+            states instead of the whole instance descriptions. Ignored when
+            filtering by instance_name, which requires DescribeInstances.
+
+        Returns
+        -------
+        Iterator[Dict[str, str]]
+            Instance id, name (unless with_names is False) and state (pending,
+            running, stopped...).
+
+        Raises
+        ------
+        InstanceNotFoundError
+            If instance_name is given and no instance matches it.
+        """
+        if not with_names and (instance_ids or not instance_name):
+            return (
+                {
+                    "InstanceId": status["InstanceId"],
+                    "State": status["InstanceState"]["Name"],
+                }
+                for status in self._iter_instance_states(instance_ids)
+            )
+
+        # the first page is read right away so a missing instance raises here
+        instances = _peek(
+            self._describe_instances(
+                [instance_name] if instance_name else None, instance_ids
+            )
+        )
+        if instances is None:
+            if instance_name:
+                raise InstanceNotFoundError(instance_name)
+            return iter(())
+
+        return (
+            {
+                "InstanceId": instance["InstanceId"],
+                "Name": _instance_name(instance),
+                "State": instance["State"]["Name"],
+            }
+            for instance in instances
+        )
+
+    def _get_cpu_averages(
+        self,
+        dimension: str,
+        values: List[str],
+        start_time: datetime,
+        end_time: datetime,
+        period: int,
+    ) -> Dict[str, float]:
+        """
+        Get the average CPU utilization of up to 500 dimension values at once.
+
+        Parameters
+        ----------
+        dimension : str
+            CloudWatch dimension, InstanceId or AutoScalingGroupName.
+        values : List[str]
+            Dimension values, at most METRIC_DATA_QUERIES_LIMIT of them.
+        start_time : datetime
+            Start of the time window.
+        end_time : datetime
+            End of the time window.
+        period : int
+            Metric period, in seconds.
+
+        Returns
+        -------
+        Dict[str, float]
+            Average CPU utilization by dimension value. Values without
+            datapoints are left out.
+        """
+        queries = [
+            {
+                "Id": f"m{i}",
+                "MetricStat": {
+                    "Metric": {
+                        "Namespace": "AWS/EC2",
+                        "MetricName": "CPUUtilization",
+                        "Dimensions": [{"Name": dimension, "Value": value}],
+                    },
+                    "Period": period,
+                    "Stat": "Average",
+                },
+                "ReturnData": True,
+            }
+            for i, value in enumerate(values)
+        ]
+
+        kwargs: Dict[str, Any] = dict(
+            MetricDataQueries=queries, StartTime=start_time, EndTime=end_time
+        )
+
+        averages: Dict[str, float] = dict()
+        while True:
+            response = self.cw_client.get_metric_data(**kwargs)
+            for result in response["MetricDataResults"]:
+                if result["Values"]:
+                    averages[values[int(result["Id"][1:])]] = result["Values"][0]
+
+            if "NextToken" not in response:
+                break
+            kwargs["NextToken"] = response["NextToken"]
+
+        return averages
+
+    def _iter_cpu_averages(
+        self,
+        dimension: str,
+        chunks: Iterable[list],
+        key: Callable[[Any], str],
+        start_time: datetime,
+        end_time: datetime,
+        period: int,
+    ) -> Iterator[Tuple[list, Dict[str, float]]]:
+        """
+        Query the CPU utilization of several chunks concurrently.
+
+        At most CPU_USAGE_WORKERS GetMetricData requests are in flight, so
+        chunks are only pulled from the (possibly lazy) iterable as results
+        are consumed, and the results keep the chunks order.
+
+        Parameters
+        ----------
+        dimension : str
+            CloudWatch dimension, InstanceId or AutoScalingGroupName.
+        chunks : Iterable[list]
+            Chunks of at most METRIC_DATA_QUERIES_LIMIT items.
+        key : Callable[[Any], str]
+            Gets the dimension value of an item.
+        start_time : datetime
+            Start of the time window.
+        end_time : datetime
+            End of the time window.
+        period : int
+            Metric period, in seconds.
+
+        Yields
+        ------
+        Tuple[list, Dict[str, float]]
+            Each chunk and the average CPU utilization by dimension value.
+        """
+        with ThreadPoolExecutor(max_workers=CPU_USAGE_WORKERS) as executor:
+            pending: Deque[Tuple[list, Future]] = deque()
+            for chunk in chunks:
+                future = executor.submit(
+                    self._get_cpu_averages,
+                    dimension,
+                    [key(item) for item in chunk],
+                    start_time,
+                    end_time,
+                    period,
+                )
+                pending.append((chunk, future))
+
+                if len(pending) >= CPU_USAGE_WORKERS:
+                    chunk, future = pending.popleft()
+                    yield chunk, future.result()
+
+            while pending:
+                chunk, future = pending.popleft()
+                yield chunk, future.result()
+
+    def _iter_group_cpu_usage(
+        self,
+        instances: Iterable[dict],
+        start_time: datetime,
+        end_time: datetime,
+        period: int,
+    ) -> Iterator[Dict[str, Any]]:
+        """Get the average CPU utilization of the instances' Auto Scaling groups."""
+        groups = {
+            _tag_value(instance, "aws:autoscaling:groupName") for instance in instances
+        }
+        group_names = sorted(group for group in groups if group)
+
+        chunks = (
+            group_names[offset : offset + METRIC_DATA_QUERIES_LIMIT]
+            for offset in range(0, len(group_names), METRIC_DATA_QUERIES_LIMIT)
+        )
+
+        for chunk, averages in self._iter_cpu_averages(
+            "AutoScalingGroupName", chunks, str, start_time, end_time, period
+        ):
+            for group in chunk:
+                yield {
+                    "AutoScalingGroupName": group,
+                    "CPUUtilization": averages.get(group),
+                }
+
+    def _iter_instance_cpu_usage(
+        self,
+        instances: Iterator[dict],
+        start_time: datetime,
+        end_time: datetime,
+        period: int,
+    ) -> Iterator[Dict[str, Any]]:
+        """Get the average CPU utilization of each instance."""
+        chunks = iter(lambda: list(islice(instances, METRIC_DATA_QUERIES_LIMIT)), [])
+
+        for chunk, averages in self._iter_cpu_averages(
+            "InstanceId",
+            chunks,
+            lambda instance: instance["InstanceId"],
+            start_time,
+            end_time,
+            period,
+        ):
+            for instance in chunk:
+                yield {
+                    "InstanceId": instance["InstanceId"],
+                    "Name": _instance_name(instance),
+                    "CPUUtilization": averages.get(instance["InstanceId"]),
+                }
+
+    def get_instance_cpu_usage(
+        self,
+        instance_name: Optional[str] = None,
+        period: int = 300,
+        instance_ids: Optional[List[str]] = None,
+        group_by: str = "instance",
+    ) -> Iterator[Dict[str, Any]]:
+        """
+        Get the average CPU utilization of instances over the last period.
+
+        Instances are read page by page and queried through batched CloudWatch
+        GetMetricData calls (up to 500 metrics per call, several calls in
+        parallel) instead of one call per instance. With
+        group_by="auto_scaling_group", a single metric per Auto Scaling group
+        is queried instead of one per instance. Results are yielded batch by
+        batch; wrap the call with list() to get them all at once.
+
+        Parameters
+        ----------
+        instance_name : Optional[str], optional
+            Value of the instance "Name" tag, by default None (all instances).
+        period : int, optional
+            Time window and metric period, in seconds, by default 300. Must be
+            1, 5, 10, 30 or a multiple of 60, as required by CloudWatch.
+        instance_ids : Optional[List[str]], optional
+            Instance ids, by default None. Takes precedence over instance_name.
+        group_by : str, optional
+            "instance" or "auto_scaling_group", by default "instance".
+            Instances outside an Auto Scaling group are left out of the
+            aggregated result.
+
+        Returns
+        -------
+        Iterator[Dict[str, Any]]
+            Instance id, name and average CPU utilization (None when
+            CloudWatch has no datapoints for the instance), or Auto Scaling
+            group name and average CPU utilization when aggregated.
+
+        Raises
+        ------
+        ValueError
+            If period is not accepted by CloudWatch or group_by is unknown.
+        InstanceNotFoundError
+            If instance_name is given and no instance matches it.
+        """
+        if period not in HIGH_RESOLUTION_PERIODS and (period <= 0 or period % 60):
+            raise ValueError(
+                f"period must be one of {HIGH_RESOLUTION_PERIODS} or a multiple "
+                f"of 60, not {period}."
+            )
+
+        if group_by not in CPU_USAGE_GROUPS:
+            raise ValueError(
+                f"group_by must be one of {CPU_USAGE_GROUPS}, not '{group_by}'."
+            )
+
+        # one window for every instance, aligned to the minute so CloudWatch
+        # can serve it from already aggregated datapoints
+        end_time = datetime.now(timezone.utc).replace(second=0, microsecond=0)
+        start_time = end_time - timedelta(seconds=period)
+
+        # the first page is read right away so a missing instance raises here
+        instances = _peek(
+            self._describe_instances(
+                [instance_name] if instance_name else None, instance_ids
+            )
+        )
+        if instances is None:
+            if instance_name:
+                raise InstanceNotFoundError(instance_name)
+            return iter(())
+
+        if group_by == "auto_scaling_group":
+            return self._iter_group_cpu_usage(instances, start_time, end_time, period)
+
+        return self._iter_instance_cpu_usage(instances, start_time, end_time, period)
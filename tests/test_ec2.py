@@ -0,0 +1,364 @@
+import gc
+import time
+import weakref
+
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+
+import boto3
+import pytest
+
+from botree import ec2 as ec2_module
+from botree.ec2 import DESCRIBE_BATCH_DELAY
+from botree.ec2 import EC2
+from botree.ec2 import InstanceNotFoundError
+from moto import mock_cloudwatch
+from moto import mock_ec2
+
+
+def run_instances(botree_session, names, tags=[]):
+    """Launch one tagged moto instance per name."""
+    client = botree_session.session.client("ec2")
+    for name in names:
+        client.run_instances(
+            ImageId="ami-12c6146b",
+            MinCount=1,
+            MaxCount=1,
+            TagSpecifications=[
+                {
+                    "ResourceType": "instance",
+                    "Tags": [{"Key": "Name", "Value": name}, *tags],
+                }
+            ],
+        )
+
+
+def test_get_instance_cpu_usage(botree_session):
+    with mock_ec2(), mock_cloudwatch():
+        names = ["botree-dev-1", "botree-dev-2"]
+        run_instances(botree_session, names)
+
+        usage = list(botree_session.ec2.get_instance_cpu_usage())
+
+        assert sorted(instance["Name"] for instance in usage) == names
+        for instance in usage:
+            assert instance["InstanceId"].startswith("i-")
+            assert "CPUUtilization" in instance
+
+
+def test_get_instance_cpu_usage_batches(botree_session):
+    """Map GetMetricData results back to instances across chunks and pages."""
+    instance_ids = [f"i-{i:08x}" for i in range(501)]
+
+    ec2 = EC2(botree_session.session, cache_ttl=None)
+    ec2.ec2_client = mock.Mock()
+    ec2.ec2_client.get_paginator.return_value.paginate.return_value = [
+        {
+            "Reservations": [
+                {
+                    "Instances": [
+                        {"InstanceId": instance_id, "Tags": []}
+                        for instance_id in instance_ids
+                    ]
+                }
+            ]
+        }
+    ]
+
+    def get_metric_data(MetricDataQueries, StartTime, EndTime, NextToken=None):
+        """Answer half of the queries per page, with the instance index as value."""
+        assert len(MetricDataQueries) <= 500
+        half = len(MetricDataQueries) // 2
+        queries = MetricDataQueries[half:] if NextToken else MetricDataQueries[:half]
+        results = []
+        for query in queries:
+            instance_id = query["MetricStat"]["Metric"]["Dimensions"][0]["Value"]
+            results.append(
+                {"Id": query["Id"], "Values": [float(int(instance_id[2:], 16))]}
+            )
+
+        response = {"MetricDataResults": results}
+        if not NextToken:
+            response["NextToken"] = "next-page"
+        return response
+
+    ec2.cw_client = mock.Mock()
+    ec2.cw_client.get_metric_data.side_effect = get_metric_data
+
+    usage = list(ec2.get_instance_cpu_usage())
+
+    # two chunks (500 + 1 queries), two pages each
+    assert ec2.cw_client.get_metric_data.call_count == 4
+    assert [instance["InstanceId"] for instance in usage] == instance_ids
+    assert [instance["CPUUtilization"] for instance in usage] == [
+        float(i) for i in range(501)
+    ]
+
+
+def test_get_instance_cpu_usage_by_group(botree_session):
+    with mock_ec2(), mock_cloudwatch():
+        group_tag = {"Key": "aws:autoscaling:groupName", "Value": "botree-asg"}
+        run_instances(botree_session, ["botree-dev-1", "botree-dev-2"], [group_tag])
+        run_instances(botree_session, ["botree-dev-3"])
+
+        usage = list(
+            botree_session.ec2.get_instance_cpu_usage(group_by="auto_scaling_group")
+        )
+
+        assert [group["AutoScalingGroupName"] for group in usage] == ["botree-asg"]
+
+        with pytest.raises(ValueError):
+            botree_session.ec2.get_instance_cpu_usage(group_by="region")
+
+        with pytest.raises(ValueError):
+            botree_session.ec2.get_instance_cpu_usage(period=90)
+
+
+def test_stop_start_instances(botree_session):
+    with mock_ec2():
+        names = ["botree-dev-1", "botree-dev-2"]
+        run_instances(botree_session, names)
+
+        transitions = botree_session.ec2.stop_instances(names + ["botree-missing"])
+
+        states = {change["Name"]: change["CurrentState"] for change in transitions}
+        assert states == {
+            "botree-dev-1": "stopping",
+            "botree-dev-2": "stopping",
+            "botree-missing": "not-found",
+        }
+
+        transitions = botree_session.ec2.start_instance("botree-dev-1")
+
+        assert [change["Name"] for change in transitions] == ["botree-dev-1"]
+        assert transitions[0]["CurrentState"] == "pending"
+
+
+def test_stop_instances_wildcard(botree_session):
+    with mock_ec2():
+        run_instances(botree_session, ["web-1", "web-2", "db-1"])
+
+        transitions = botree_session.ec2.stop_instances(["web-*", "cache-*"])
+
+        states = sorted(
+            (change["Name"], change["CurrentState"]) for change in transitions
+        )
+        assert states == [
+            ("cache-*", "not-found"),
+            ("web-1", "stopping"),
+            ("web-2", "stopping"),
+        ]
+
+
+def test_stop_instances_unknown_id(botree_session):
+    with mock_ec2():
+        run_instances(botree_session, ["botree-dev-1"])
+        unknown_id = "i-0123456789abcdef0"
+
+        transitions = botree_session.ec2.stop_instances(["botree-dev-1", unknown_id])
+
+        states = {
+            change["InstanceId"]: change["CurrentState"] for change in transitions
+        }
+        assert states.pop(unknown_id) == "not-found"
+        assert list(states.values()) == ["stopping"]
+
+        with pytest.raises(InstanceNotFoundError):
+            botree_session.ec2.start_instance(instance_id=unknown_id)
+
+
+def test_stop_missing_instance(botree_session):
+    with mock_ec2():
+        with pytest.raises(InstanceNotFoundError):
+            botree_session.ec2.stop_instance("botree-missing")
+
+
+def test_get_instance_id(botree_session):
+    with mock_ec2():
+        run_instances(botree_session, ["botree-dev-1", "botree-dev-2"])
+
+        instance_ids = botree_session.ec2.get_instance_id("botree-dev-1")
+
+        assert len(instance_ids) == 1
+        assert instance_ids[0].startswith("i-")
+        assert len(botree_session.ec2.get_instance_id()) == 2
+
+        with pytest.raises(InstanceNotFoundError):
+            botree_session.ec2.get_instance_id("botree-missing")
+
+
+def test_concurrent_lookups_are_batched(botree_session):
+    with mock_ec2():
+        names = [f"botree-dev-{i}" for i in range(5)]
+        run_instances(botree_session, names)
+
+        client = botree_session.ec2.ec2_client
+        original = client.describe_instances
+
+        def slow_describe(**kwargs):
+            time.sleep(0.1)
+            return original(**kwargs)
+
+        describe = mock.Mock(side_effect=slow_describe)
+        client.describe_instances = describe
+
+        def stop(name):
+            return botree_session.ec2.stop_instance(name)
+
+        with ThreadPoolExecutor(max_workers=len(names)) as executor:
+            results = list(executor.map(stop, names))
+
+        # the first lookup is sent alone, the others wait for it and go together
+        assert describe.call_count == 2
+        assert [result[0]["Name"] for result in results] == names
+
+
+def test_wildcard_name_lookup(botree_session):
+    with mock_ec2():
+        run_instances(botree_session, ["web-1", "web-2", "db-1"])
+
+        batched = botree_session.ec2.get_instance_id("web-?")
+        unbatched = EC2(botree_session.session, batch_delay=None).get_instance_id(
+            "web-*"
+        )
+
+        assert len(batched) == 2
+        assert sorted(batched) == sorted(unbatched)
+
+
+def test_lone_lookup_is_not_delayed(botree_session):
+    with mock_ec2():
+        run_instances(botree_session, ["botree-dev-1"])
+
+        start = time.monotonic()
+        botree_session.ec2.get_instance_id("botree-dev-1")
+
+        assert time.monotonic() - start < DESCRIBE_BATCH_DELAY
+
+
+def test_get_instance_status(botree_session):
+    with mock_ec2():
+        names = ["botree-dev-1", "botree-dev-2"]
+        run_instances(botree_session, names)
+        botree_session.ec2.stop_instances(["botree-dev-2"])
+
+        statuses = list(botree_session.ec2.get_instance_status())
+
+        states = {status["Name"]: status["State"] for status in statuses}
+        assert states == {"botree-dev-1": "running", "botree-dev-2": "stopped"}
+
+        with pytest.raises(ValueError):
+            botree_session.ec2.get_instance_status("botree-missing")
+
+
+def test_describe_instances_cache(botree_session):
+    with mock_ec2(), mock_cloudwatch():
+        run_instances(botree_session, ["botree-dev-1"])
+
+        # a long ttl keeps the test away from the cache time bucket boundary
+        botree_session.ec2.cache_ttl = 3600
+        client = botree_session.ec2.ec2_client
+        describe = mock.Mock(wraps=client.describe_instances)
+        client.describe_instances = describe
+
+        list(botree_session.ec2.get_instance_status())
+        list(botree_session.ec2.get_instance_cpu_usage())
+
+        assert describe.call_count == 1
+
+        botree_session.ec2.stop_instances(["botree-dev-1"])
+        statuses = list(botree_session.ec2.get_instance_status())
+
+        assert statuses[0]["State"] == "stopped"
+
+
+def test_cache_ignores_listings_older_than_a_state_change(botree_session):
+    with mock_ec2():
+        run_instances(botree_session, ["botree-dev-1"])
+        botree_session.ec2.cache_ttl = 3600
+
+        statuses = botree_session.ec2.get_instance_status()
+        botree_session.ec2.stop_instances(["botree-dev-1"])
+        list(statuses)
+
+        statuses = list(botree_session.ec2.get_instance_status())
+
+        assert statuses[0]["State"] == "stopped"
+
+
+def test_instance_ids_skip_lookup(botree_session):
+    with mock_ec2():
+        run_instances(botree_session, ["botree-dev-1"])
+
+        ec2 = botree_session.ec2
+        instance_id = next(ec2.get_instance_status("botree-dev-1"))["InstanceId"]
+
+        describe = mock.Mock(wraps=ec2.ec2_client.describe_instances)
+        ec2.ec2_client.describe_instances = describe
+
+        transitions = ec2.stop_instance(instance_id)
+        assert transitions[0]["InstanceId"] == instance_id
+        assert transitions[0]["CurrentState"] == "stopping"
+
+        transitions = ec2.start_instance(instance_id=instance_id)
+        assert transitions[0]["CurrentState"] == "pending"
+
+        assert describe.call_count == 0
+
+        statuses = list(ec2.get_instance_status(instance_ids=[instance_id]))
+        assert statuses[0]["Name"] == "botree-dev-1"
+
+
+def test_get_instance_status_without_names(botree_session):
+    with mock_ec2():
+        run_instances(botree_session, ["botree-dev-1", "botree-dev-2"])
+        instance_id = botree_session.ec2.get_instance_id("botree-dev-2")[0]
+        botree_session.ec2.stop_instances(instance_ids=[instance_id])
+
+        statuses = botree_session.ec2.get_instance_status(with_names=False)
+
+        states = {status["InstanceId"]: status["State"] for status in statuses}
+        assert len(states) == 2
+        assert states[instance_id] == "stopped"
+
+        statuses = list(
+            botree_session.ec2.get_instance_status(
+                instance_ids=[instance_id], with_names=False
+            )
+        )
+        assert statuses == [{"InstanceId": instance_id, "State": "stopped"}]
+
+
+def test_clients_are_shared_per_session(botree_session):
+    first = EC2(botree_session.session)
+    second = EC2(botree_session.session)
+
+    assert first is not second
+    assert first.ec2_client is second.ec2_client
+    assert first.cw_client is second.cw_client
+
+    custom = EC2(botree_session.session, client_kwargs={"region_name": "us-west-2"})
+    assert custom.ec2_client is not first.ec2_client
+    assert custom.ec2_client.meta.region_name == "us-west-2"
+
+
+def test_shared_clients_are_released_with_the_session():
+    gc.collect()
+    registered = len(ec2_module._shared_clients)
+
+    session = boto3.session.Session(
+        aws_access_key_id="testing",
+        aws_secret_access_key="testing",
+        region_name="us-east-1",
+    )
+    EC2(session).ec2_client
+
+    assert session in ec2_module._shared_clients
+    assert len(ec2_module._shared_clients) == registered + 1
+
+    session_ref = weakref.ref(session)
+    del session
+    gc.collect()
+
+    assert session_ref() is None
+    assert len(ec2_module._shared_clients) == registered